@@ -3,18 +3,192 @@
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import zipfile
+import hashlib
 import io
-import math
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+from scipy.spatial import cKDTree
+
+# Matches frame_000123.png / .jpg / .jpeg, capturing the frame number
+FRAME_RE = re.compile(r'^frame_(\d+)\.(?:png|jpe?g)$', re.IGNORECASE)
 
 # Remove decimals helper
 def remove_decimals(df: pd.DataFrame) -> pd.DataFrame:
-    for col in df.columns:
-        if col.endswith(("_X", "_Y", "_Z")):
-            df[col] = df[col].round().astype("Int64")
+    # Round all coordinate columns in one vectorized pass instead of
+    # column-by-column; plain int32 keeps comparisons on native dtype.
+    cols = [c for c in df.columns if c.endswith(("_X", "_Y", "_Z"))]
+    if cols:
+        # rint into a fresh array: pyarrow-parsed frames can expose
+        # read-only zero-copy blocks that reject in-place ops
+        arr = np.rint(df[cols].to_numpy(dtype=np.float32, copy=False))
+        if np.isnan(arr).any():
+            # missing coordinates: the int32 cast would wrap NaN to
+            # INT_MIN, so keep the nullable dtype and preserve them as NA
+            df[cols] = df[cols].round().astype("Int64")
+        else:
+            df[cols] = arr.astype(np.int32)
     return df
 
+def upload_key(file_bytes: bytes) -> bytes:
+    """Stable digest of an upload, used as the cache key everywhere below.
+
+    st.file_uploader returns a fresh object each rerun, and letting the
+    caches hash megabytes of raw bytes on every call is wasted work; a
+    16-byte BLAKE2b digest is computed once per rerun instead.
+    """
+    return hashlib.blake2b(file_bytes, digest_size=16).digest()
+
+# Cached loaders — keyed on the upload digest so the expensive parsing
+# runs once per upload instead of on every rerun.
+@st.cache_data(show_spinner=False)
+def load_csv(_file_bytes: bytes, key: bytes):
+    try:
+        # pyarrow's multi-threaded reader is several times faster than
+        # pandas' C engine on wide numeric CSVs
+        df = pd.read_csv(io.BytesIO(_file_bytes), engine='pyarrow')
+    except (ImportError, ValueError):
+        # pyarrow missing or the file needs the more forgiving C parser
+        df = pd.read_csv(io.BytesIO(_file_bytes))
+    df = remove_decimals(df)
+    # Frame -> row positions, so per-frame lookups are O(rows-per-frame)
+    # instead of a full-table scan on every rerun.
+    indices = df.groupby('Frame', sort=False).indices
+    # Sorted frame numbers as one int array; slider positions index it
+    # directly and np.searchsorted covers any reverse lookup.
+    frames_arr = np.unique(df['Frame'].to_numpy())
+    return df, indices, frames_arr
+
+# Keep the zip open and index frame number -> entry name without
+# extracting the archive; the thumbnail build below reads from it.
+# cache_resource because a ZipFile handle is not serializable.
+@st.cache_resource(show_spinner=False)
+def open_zip(_zip_bytes: bytes, key: bytes):
+    zf = zipfile.ZipFile(io.BytesIO(_zip_bytes))
+    frame_to_name = {}
+    for fname in zf.namelist():
+        m = FRAME_RE.match(fname.split("/")[-1])
+        if m:
+            frame_to_name[int(m.group(1))] = fname
+    return zf, frame_to_name
+
+# Downsample one frame to display size. st.image takes raw bytes as-is,
+# so frames that are already display sized skip the decode + re-encode
+# round-trip entirely (Image.open only reads the header for the size).
+def decode_thumbnail(zf: zipfile.ZipFile, name: str) -> bytes:
+    raw = zf.read(name)
+    im = Image.open(io.BytesIO(raw))
+    if max(im.size) <= 1280:
+        return raw
+    im.thumbnail((1280, 1280))
+    if im.mode not in ("RGB", "L"):
+        im = im.convert("RGB")
+    buf = io.BytesIO()
+    im.save(buf, format='JPEG', quality=85)
+    return buf.getvalue()
+
+# Pre-decode every frame to a compact display thumbnail at upload time,
+# fanned out across a thread pool (PIL releases the GIL during decode
+# and encode). Navigation then costs a dict lookup, and peak memory is
+# frames x thumbnail bytes instead of full-resolution PNGs.
+# cache_resource, not cache_data: the dict is large and read-only, and
+# cache_data would deserialize a fresh copy of it on every rerun.
+@st.cache_resource(show_spinner=False)
+def build_thumbnails(_zf, key: bytes, _frame_to_name: dict) -> dict:
+    entries = sorted(_frame_to_name.items())
+    thumbs = {}
+    if not entries:
+        return thumbs
+    progress = st.progress(0.0, text="Preparing frames…")
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futures = [(idx, ex.submit(decode_thumbnail, _zf, name)) for idx, name in entries]
+        for n, (idx, fut) in enumerate(futures, start=1):
+            thumbs[idx] = fut.result()
+            if n % 32 == 0 or n == len(futures):
+                progress.progress(n / len(futures), text=f"Preparing frames… {n}/{len(futures)}")
+    progress.empty()
+    return thumbs
+
+# The per-frame view: slice the frame's rows, reapply known mappings and
+# compute ReID suggestions. Pure — suggested assignments are returned for
+# the caller to fold into session state — so it can be memoized on the
+# frame plus snapshots of the state it reads; repeat renders of the same
+# frame (e.g. after an editor submit) skip the nearest-neighbor work.
+@st.cache_data(show_spinner=False, max_entries=128)
+def build_frame_view(csv_key: bytes, frame_idx, mapping_items: tuple,
+                     uninterested_items: tuple, names: tuple, necks_key: bytes,
+                     _df: pd.DataFrame, _indices: dict, _necks_arr: np.ndarray):
+    # Slice only the columns the view needs; copying the full frame would
+    # duplicate every joint's coordinates just to edit PersonName.
+    rows_idx = _indices[frame_idx]
+    bid_arr = _df['BodyID'].to_numpy()[rows_idx]
+    # Neck coordinates as one (rows, 3) array, indexed positionally —
+    # no per-row Python tuples.
+    neck_xyz = _df[['NECK_X', 'NECK_Y', 'NECK_Z']].to_numpy()[rows_idx]
+
+    # Reapply previous mappings with one vectorized map instead of
+    # cell-at-a-time iterrows writes.
+    id_to_name = dict(mapping_items)
+    # copy=True: under pandas copy-on-write to_numpy can hand back a
+    # read-only view, and the suggestion loop writes into this array
+    person = pd.Series(bid_arr).map(id_to_name).fillna('').to_numpy(copy=True)
+    used = set(person[person != ''])
+
+    # Suggest names for still-unmapped rows by nearest previous neck,
+    # batched over all rows instead of a per-row Python scan. Iteration
+    # stays proportional to the (usually few) unassigned rows.
+    uninterested = set(uninterested_items)
+    to_assign = [int(p) for p in np.flatnonzero(person == '')
+                 if bid_arr[p] not in uninterested]
+    cand_idx = np.flatnonzero(~np.isnan(_necks_arr[:, 0])
+                              & np.array([n not in used for n in names]))
+    new_mappings = []
+    if to_assign and cand_idx.size:
+        neck_pts = neck_xyz[to_assign].astype(np.float64)
+        candidate_pts = _necks_arr[cand_idx].astype(np.float64)
+        if cand_idx.size < 8:
+            # brute-force NumPy beats tree-build overhead for a handful of names
+            order = None
+        else:
+            tree = cKDTree(candidate_pts)
+            _, order = tree.query(neck_pts, k=cand_idx.size)
+            order = order.reshape(len(to_assign), -1)
+        taken = np.zeros(cand_idx.size, dtype=bool)
+        for r, p in enumerate(to_assign):
+            if taken.all():
+                break
+            if order is None:
+                d = np.linalg.norm(candidate_pts - neck_pts[r], axis=1)
+                d[taken] = np.inf
+                j = int(d.argmin())
+            else:
+                j = next(int(c) for c in order[r] if not taken[int(c)])
+            taken[j] = True
+            best = names[cand_idx[j]]
+            person[p] = best
+            new_mappings.append((bid_arr[p], best, tuple(neck_xyz[p])))
+
+    display = pd.DataFrame({
+        'Frame': _df['Frame'].to_numpy()[rows_idx],
+        'Timestamp': _df['Timestamp'].to_numpy()[rows_idx],
+        'BodyID': bid_arr,
+        'PersonName': person,
+    })
+    return display, neck_xyz, new_mappings
+
+# Keyed on the upload digest plus a hashable snapshot of the mapping, so
+# re-clicking Export with no new edits returns the same bytes instantly.
+@st.cache_data(show_spinner=False)
+def build_export_csv(csv_key: bytes, mapping_items: tuple, _df: pd.DataFrame) -> bytes:
+    names = _df['BodyID'].map(dict(mapping_items))
+    mask = names.notna() & (names != '')
+    out_df = _df.loc[mask].assign(PersonName=names[mask])
+    out_df = out_df[_df.columns.tolist() + ['PersonName']]
+    return out_df.to_csv(index=False).encode('utf-8')
+
 # Display current limit (for verification)
 # st.write("Max upload size is:", st.get_option("server.maxUploadSize"), "MB")
 
@@ -33,28 +207,39 @@ if csv_file and zip_file and names_text:
         st.error("Please enter at least one person name.")
         st.stop()
 
-    # Load CSV & strip decimals
-    df = pd.read_csv(csv_file)
-    df = remove_decimals(df)
+    # Load CSV & strip decimals (cached on the upload digest)
+    csv_bytes = csv_file.getvalue()
+    csv_key = upload_key(csv_bytes)
+    df, frame_indices, frames = load_csv(csv_bytes, csv_key)
 
-    # Load images from zip
-    zip_bytes = io.BytesIO(zip_file.read())
-    zf = zipfile.ZipFile(zip_bytes)
-    img_map = {}
-    for fname in zf.namelist():
-        base = fname.split("/")[-1]
-        if base.startswith("frame_") and base.lower().endswith((".png", ".jpg", ".jpeg")):
-            idx = int(base.replace('frame_','').split('.')[0])
-            img_map[idx] = zf.read(fname)
+    # Index the zip without extracting it (cached on the upload digest)
+    zip_bytes = zip_file.getvalue()
+    zip_key = upload_key(zip_bytes)
+    zf, frame_to_name = open_zip(zip_bytes, zip_key)
+    thumbs = build_thumbnails(zf, zip_key, frame_to_name)
 
     # Initialize session state
     if 'pos' not in st.session_state:
         st.session_state.pos = 0
         st.session_state.id_to_name = {}
-        st.session_state.name_to_neck = {}
         st.session_state.uninterested = set()
 
-    frames = sorted(df['Frame'].unique())
+    # Struct-of-arrays neck store: row i is the last seen neck for
+    # person_names[i], NaN while the name has no neck yet. One contiguous
+    # array keeps the ReID distance math a single C-level pass.
+    if st.session_state.get('neck_names') != person_names:
+        necks = np.full((len(person_names), 3), np.nan, dtype=np.float32)
+        old_names = st.session_state.get('neck_names')
+        if old_names:
+            old_necks = st.session_state.necks_arr
+            for i, n in enumerate(person_names):
+                if n in old_names:
+                    necks[i] = old_necks[old_names.index(n)]
+        st.session_state.neck_names = person_names
+        st.session_state.necks_arr = necks
+    name_idx = {n: i for i, n in enumerate(person_names)}
+    necks_arr = st.session_state.necks_arr
+
     total = len(frames)
 
     # Sidebar navigation
@@ -67,68 +252,59 @@ if csv_file and zip_file and names_text:
     frame_idx = frames[st.session_state.pos]
     st.subheader(f"Frame {frame_idx} ({st.session_state.pos + 1}/{total})")
 
-    # Display image
-    if frame_idx in img_map:
-        img = Image.open(io.BytesIO(img_map[frame_idx]))
-        st.image(img, use_container_width=True)
+    # Display image (pre-decoded at upload, so this is a dict lookup)
+    if frame_idx in thumbs:
+        st.image(thumbs[frame_idx], use_container_width=True)
     else:
         st.warning("Image not found for this frame.")
 
-    # Filter rows for this frame
-    sub = df[df['Frame'] == frame_idx].copy()
-    sub['_neck'] = list(zip(sub['NECK_X'], sub['NECK_Y'], sub['NECK_Z']))
-
-    # Reapply previous mappings and suggestions
-    used = set()
-    for i, row in sub.iterrows():
-        bid = row['BodyID']
-        mapped = st.session_state.id_to_name.get(bid, "")
-        if mapped:
-            sub.at[i, 'PersonName'] = mapped
-            used.add(mapped)
-        else:
-            sub.at[i, 'PersonName'] = ""
-
-    for i, row in sub.iterrows():
-        if not row['PersonName'] and row['BodyID'] not in st.session_state.uninterested:
-            neck = row['_neck']
-            best, bdist = None, None
-            for name, prev in st.session_state.name_to_neck.items():
-                if name in used:
-                    continue
-                d = math.dist(neck, prev)
-                if best is None or d < bdist:
-                    best, bdist = name, d
-            if best:
-                sub.at[i, 'PersonName'] = best
-                st.session_state.id_to_name[row['BodyID']] = best
-                st.session_state.name_to_neck[best] = neck
-                used.add(best)
-
-    # Editable DataEditor
-    edited = st.data_editor(
-        sub[['Frame','Timestamp','BodyID','PersonName']],
-        column_config={
-            'PersonName': st.column_config.SelectboxColumn(
-                'PersonName', options=[""] + person_names
-            )
-        },
-        hide_index=True,
-        key='editor'
+    # Rows for this frame plus ReID suggestions, memoized on the frame
+    # and snapshots of the state it reads; suggested assignments are
+    # folded into session state out here to keep the cached call pure.
+    display, neck_xyz, new_mappings = build_frame_view(
+        csv_key, frame_idx,
+        tuple(sorted(st.session_state.id_to_name.items())),
+        tuple(sorted(st.session_state.uninterested)),
+        tuple(person_names), necks_arr.tobytes(),
+        df, frame_indices, necks_arr,
     )
+    for bid, name, neck in new_mappings:
+        st.session_state.id_to_name[bid] = name
+        necks_arr[name_idx[name]] = neck
 
-    # Persist edits
-    for _, r in edited.iterrows():
-        bid = r['BodyID']
-        name = r['PersonName']
-        if name:
-            st.session_state.id_to_name[bid] = name
-            neck = sub.loc[sub['BodyID'] == bid, '_neck'].iloc[0]
-            st.session_state.name_to_neck[name] = neck
-            st.session_state.uninterested.discard(bid)
-        else:
-            st.session_state.id_to_name.pop(bid, None)
-            st.session_state.uninterested.add(bid)
+    # Editable DataEditor inside a form: cell edits accumulate in the
+    # client and only the Apply click triggers a rerun, instead of the
+    # whole script re-running on every edited cell.
+    with st.form("edit_frame", clear_on_submit=False):
+        edited = st.data_editor(
+            display,
+            column_config={
+                'PersonName': st.column_config.SelectboxColumn(
+                    'PersonName', options=[""] + person_names
+                )
+            },
+            hide_index=True,
+            key='editor'
+        )
+        submitted = st.form_submit_button("Apply")
+
+    # Persist edits on submit
+    if submitted:
+        # BodyID -> row position once, instead of a boolean scan per row
+        bid_arr = display['BodyID'].to_numpy()
+        bid_to_pos = dict(zip(bid_arr.tolist(), range(len(bid_arr))))
+        for _, r in edited.iterrows():
+            bid = r['BodyID']
+            name = r['PersonName']
+            if name:
+                st.session_state.id_to_name[bid] = name
+                pos = bid_to_pos.get(bid)
+                if pos is not None and name in name_idx:
+                    necks_arr[name_idx[name]] = neck_xyz[pos]
+                st.session_state.uninterested.discard(bid)
+            else:
+                st.session_state.id_to_name.pop(bid, None)
+                st.session_state.uninterested.add(bid)
 
     # Controls
     col1, col2, col3 = st.columns([1,1,1])
@@ -137,16 +313,6 @@ if csv_file and zip_file and names_text:
     if col2.button("Next ▶") and st.session_state.pos < total - 1:
         st.session_state.pos += 1
     if col3.button("Export Edited CSV"):
-        rows_out = []
-        for f in frames:
-            block = df[df['Frame'] == f]
-            for _, r in block.iterrows():
-                bid = r['BodyID']
-                name = st.session_state.id_to_name.get(bid, "")
-                if name:
-                    row = r.to_dict()
-                    row['PersonName'] = name
-                    rows_out.append(row)
-        out_df = pd.DataFrame(rows_out)[df.columns.tolist() + ['PersonName']]
-        csv_data = out_df.to_csv(index=False).encode('utf-8')
+        mapping_items = tuple(sorted(st.session_state.id_to_name.items()))
+        csv_data = build_export_csv(csv_key, mapping_items, df)
         st.download_button("📥 Download Edited CSV", csv_data, "edited_skeletons.csv", mime="text/csv")